@@ -1,4 +1,6 @@
 # Importing necessary libraries
+import heapq
+import math
 import random
 from mesa import Agent
 import numpy as np
@@ -8,6 +10,13 @@ from shapely import contains_xy
 # Import functions from functions.py
 from functions import calculate_EU, generate_random_location_within_map_domain, get_flood_depth, calculate_basic_flood_damage, floodplain_multipolygon
 
+# Import the lifecycle events from events.py
+from events import DEATH, DRYPROOFING_EXPIRY
+
+# quarterly saving and consumption rates households choose from (see Households.calculate_saving)
+SAVING_RATES = [0.05, 0.1, 0.15, 0.2, 0.25]
+CONSUMPTION_RATES = [0.05, 0.1, 0.15, 0.2, 0.25]
+
 
 # Define the Households agent class
 class Households(Agent):
@@ -17,7 +26,11 @@ class Households(Agent):
     In a real scenario, this would be based on actual geographical data or more complex logic.
     """
 
-    def __init__(self, unique_id, model):
+    def __init__(self, unique_id, model, attributes=None):
+        """
+        attributes: optional dict with the initial attributes of the household from a cached population
+                    snapshot (see population.py). If not given, the attributes are drawn.
+        """
         super().__init__(unique_id, model)
         # Data collection
         self.actual_damage = 0 # damage with adaptation (if any)
@@ -44,21 +57,82 @@ class Households(Agent):
         self.is_dryproofed = False  # Initial dry-proofing status set to False
         self.is_wetproofed = False  # Initial wet-proofing status set to False
 
+        # Consume or save threshold
+        self.saving_threshold = self.model.saving_threshold # Saving threshold for the household
+        # Measure efficiencies
+        self.elevation_efficiency = 1  # Efficiency of elevation
+        self.dryproofing_efficiency = 0.5  # Efficiency of dry-proofing
+        self.wetproofing_efficiency = 0.4  # Efficiency of wet-proofing
+
+        if attributes is not None:
+            # household from a cached population snapshot
+            self.set_cached_attributes(attributes)
+        else:
+            self.draw_initial_attributes()
+        # the subsidy depends on the scenario, so it is applied on top of drawn and cached households
+        self.apply_subsidy()
+
+        # Add an attribute for the actual flood depth. This is set to zero at the beginning of the simulation since there is not flood yet
+        # and will update its value when there is a shock (i.e., actual flood). Shock happens at some point during the simulation
+        self.flood_depth_actual = 0
+        
+        #calculate the actual flood damage given the actual flood depth. Flood damage is a factor between 0 and 1
+        self.flood_damage_actual = calculate_basic_flood_damage(flood_depth=self.flood_depth_actual)
+
+        # keep the old estimated and actual damage 
+        self.flood_damage_estimated_old = 0
+        self.flood_damage_actual_old = 0
+
+        # lifecycle events
+        self.dryproofing_expiry_tick = None # tick in which the dry-proofing expires (None if never dry-proofed)
+        self.schedule_death()
+
+    # Age of the household, derived from the age and tick at moving in (it increases by 1/4 every step)
+    @property
+    def age(self):
+        return self.age_at_move_in + 0.25 * (self.model.counter - self.move_in_tick)
+
+    @age.setter
+    def age(self, age):
+        self.age_at_move_in = age
+        self.move_in_tick = self.model.counter
+
+    # Remaining lifetime of the dry-proofing in quarters (total life time 20 years, i.e. 80 quarters)
+    @property
+    def dryproofing_lifetime(self):
+        if self.dryproofing_expiry_tick is None:
+            return None
+        return max(0, self.dryproofing_expiry_tick - self.model.counter)
+
+    def damage_multiplier(self):
+        """Return the factor by which the measures undergone reduce the flood damage (1 without adaptation)."""
+        multiplier = 1
+        for measure in self.measures_undergone:
+            if measure == 'elevation':
+                multiplier *= (1 - self.elevation_efficiency)
+            elif measure == 'dryproofing':
+                multiplier *= (1 - self.dryproofing_efficiency)
+            elif measure == 'wetproofing':
+                multiplier *= (1 - self.wetproofing_efficiency)
+        return multiplier
+
+    def schedule_death(self):
+        """Schedule the death of the household in the tick in which it becomes 80 (see events.py)."""
+        death_tick = self.move_in_tick + max(1, math.ceil((80 - self.age_at_move_in) * 4))
+        self.model.event_calendar.schedule(death_tick, DEATH, self.unique_id)
+
+    def draw_initial_attributes(self):
+        """Draw the demographic attributes, measure costs and location of a new household and get its flood depth."""
         # Demographic attributes
         self.age = random.randint(20, 79)  # Age of the household
         self.income = self.generate_income()  # Monthly income of the household
         self.savings_number= random.randint(1,3) # how many income the household has saved
         self.savings = self.savings_number*self.income  # Total initial savings of the household
-        # Consume or save threshold
-        self.saving_threshold = self.model.saving_threshold # Saving threshold for the household
         
-        # Measure costs and efficiencies
+        # Measure costs
         self.elevation_cost =  random.randint(30000, 40000)  # Cost of elevation
-        self.elevation_efficiency = 1  # Efficiency of elevation
         self.dryproofing_cost = random.randint(5000, 10000)  # Cost of dry-proofing
-        self.dryproofing_efficiency = 0.5  # Efficiency of dry-proofing
         self.wetproofing_cost = random.randint(3000, 8000)  # Cost of wet-proofing
-        self.wetproofing_efficiency = 0.4  # Efficiency of wet-proofing
     
         # getting flood map values
         # Get a random location on the map
@@ -75,7 +149,7 @@ class Households(Agent):
         # Get the estimated flood depth at those coordinates. 
         # the estimated flood depth is calculated based on the flood map (i.e., past data) so this is not the actual flood depth
         # Flood depth can be negative if the location is at a high elevation
-        self.flood_depth_estimated = get_flood_depth(corresponding_map=model.flood_map, location=self.location, band=model.band_flood_img)
+        self.flood_depth_estimated = get_flood_depth(corresponding_map=self.model.flood_map, location=self.location, band=self.model.band_flood_img)
         # handle negative values of flood depth
         if self.flood_depth_estimated < 0:
             self.flood_depth_estimated = 0
@@ -83,36 +157,45 @@ class Households(Agent):
         # calculate the estimated flood damage given the estimated flood depth. Flood damage is a factor between 0 and 1
         self.flood_damage_estimated = calculate_basic_flood_damage(flood_depth=self.flood_depth_estimated)
 
-        # Add an attribute for the actual flood depth. This is set to zero at the beginning of the simulation since there is not flood yet
-        # and will update its value when there is a shock (i.e., actual flood). Shock happens at some point during the simulation
-        self.flood_depth_actual = 0
-        
-        #calculate the actual flood damage given the actual flood depth. Flood damage is a factor between 0 and 1
-        self.flood_damage_actual = calculate_basic_flood_damage(flood_depth=self.flood_depth_actual)
-
-        # keep the old estimated and actual damage 
-        self.flood_damage_estimated_old = 0
-        self.flood_damage_actual_old = 0
-
-        # subsidy given if the income is below the threshold
-        if self.income <= self.model.income_threshold:
-            # print("Agent {} is eligible for subsidy".format(self.unique_id))
-            self.subsidy_rate = self.model.subsidy_rate # subsidy percentage
-        else:
-            self.subsidy_rate = 0
+    def apply_subsidy(self):
+        """
+        Set the subsidy rate based on the income of the household and recalculate the measure costs with subsidy.
+        With a government budget (see Government) subsidies are offered by the government instead of given to
+        all eligible households, so the household starts without subsidy.
+        """
         # keep track of the old measure costs
         self.elevation_cost_old = self.elevation_cost
         self.dryproofing_cost_old = self.dryproofing_cost
         self.wetproofing_cost_old = self.wetproofing_cost
+        # subsidy given if the income is below the threshold
+        if self.income <= self.model.income_threshold and self.model.government_budget is None:
+            # print("Agent {} is eligible for subsidy".format(self.unique_id))
+            self.set_subsidy_rate(self.model.subsidy_rate) # subsidy percentage
+        else:
+            self.set_subsidy_rate(0)
+
+    def set_subsidy_rate(self, subsidy_rate):
+        """Set the subsidy rate of the household and recalculate the measure costs from the costs without subsidy."""
+        self.subsidy_rate = subsidy_rate
         # Recalculate the cost with subsidy
-        self.elevation_cost = self.elevation_cost * (1-self.subsidy_rate)
-        self.dryproofing_cost = self.dryproofing_cost * (1-self.subsidy_rate)
-        self.wetproofing_cost = self.wetproofing_cost * (1-self.subsidy_rate)
+        # if not eligible subsidy rate is zero, so the cost remains the same
+        self.elevation_cost = self.elevation_cost_old * (1-self.subsidy_rate)
+        self.dryproofing_cost = self.dryproofing_cost_old * (1-self.subsidy_rate)
+        self.wetproofing_cost = self.wetproofing_cost_old * (1-self.subsidy_rate)
         # keep track of the difference between the old and new costs 
         # zero if no subsidy is given
         self.elevation_cost_diff = self.elevation_cost_old - self.elevation_cost
         self.dryproofing_cost_diff = self.dryproofing_cost_old - self.dryproofing_cost
         self.wetproofing_cost_diff = self.wetproofing_cost_old - self.wetproofing_cost
+
+    def set_cached_attributes(self, attributes):
+        """Set the initial attributes of the household from a cached population snapshot (see population.py)."""
+        for name, value in attributes.items():
+            if name not in ('x', 'y'):
+                setattr(self, name, value)
+        self.location = Point(attributes['x'], attributes['y'])
+        # the estimated flood damage follows from the cached flood depth
+        self.flood_damage_estimated = calculate_basic_flood_damage(flood_depth=self.flood_depth_estimated)
     
     # Function to calculate income for households
     def generate_income(self, alpha=2, beta=3000):
@@ -145,9 +228,9 @@ class Households(Agent):
             None
         '''
         # select consumption rate from the list
-        consumption_rate = random.choice([0.05, 0.1, 0.15, 0.2, 0.25])  
+        consumption_rate = random.choice(CONSUMPTION_RATES)
         # select saving rate from the list 
-        saving_rate =  random.choice([0.05, 0.1, 0.15, 0.2, 0.25]) 
+        saving_rate =  random.choice(SAVING_RATES)
         self.saving_old = self.savings # keep the old savings for verification
         if random.random() > self.saving_threshold:
             # Agent saves
@@ -158,6 +241,13 @@ class Households(Agent):
             amount_consumed = self.savings * consumption_rate # it is already quarterly
             self.savings -= amount_consumed
 
+
+    def possible_savings(self):
+        """Return every amount of savings the household can have after calculate_saving in this step."""
+        # same calculations as in calculate_saving, so the amounts are exactly equal
+        saved = [self.savings + self.income * saving_rate *3 for saving_rate in SAVING_RATES]
+        consumed = [self.savings - self.savings * consumption_rate for consumption_rate in CONSUMPTION_RATES]
+        return saved + consumed
             
     # Function to count friends who can be influencial.
     def count_friends(self, radius):
@@ -167,13 +257,15 @@ class Households(Agent):
 
     def step(self):
 
-        self.age += 0.25  # Age increases by 1/4 every step (quarterly)
         self.calculate_saving() # Savings updated
         # print the difference between the old and new savings
         # print("Agent {}'s savings changed from {} to {}".format(self.unique_id, self.saving_old, self.savings))
 
+        # lifecycle events that are due in this step (see events.py)
+        due_events = self.model.due_events.get(self.unique_id, ())
+
         # When agent becomes 80, it dies and its parameters are changed
-        if self.age >= 80:
+        if DEATH in due_events:
             # update the agent parameter (instead of removing and adding) 
             # we assume that the adaptations taken stay in the house
             # print("Agent {} died".format(self.unique_id))
@@ -183,63 +275,32 @@ class Households(Agent):
             self.savings = self.savings_number*self.income
             #Print agent id, location, income, age, savings
             # print("New Agent {} moved in {} with income {} and savings {} and age {}".format(self.unique_id, self.location, self.income, self.savings, self.age))
-            # Recheck subsidy eligibility  based on the new income
-            if self.income <= self.model.income_threshold:
-                self.subsidy_rate = self.model.subsidy_rate # subsidy percentage
-            else:
-                self.subsidy_rate = 0
-
             # Assign new measure costs
             self.elevation_cost =  random.randint(30000, 40000)  # Cost of elevation
             self.dryproofing_cost = random.randint(5000, 10000)  # Cost of dry-proofing
             self.wetproofing_cost = random.randint(3000, 8000)  # Cost of wet-proofing
-            # keep track of the old measure costs
-            self.elevation_cost_old = self.elevation_cost
-            self.dryproofing_cost_old = self.dryproofing_cost
-            self.wetproofing_cost_old = self.wetproofing_cost
-
-            # Recalculate the costs with subsidy
-            # if not eligible subsidy rate is zero, so the cost remains the same
-            self.elevation_cost = self.elevation_cost * (1-self.subsidy_rate)
-            self.dryproofing_cost = self.dryproofing_cost * (1-self.subsidy_rate)
-            self.wetproofing_cost = self.wetproofing_cost * (1-self.subsidy_rate)
-
-            # keep track of the difference between the old and new costs
-            # zero if no subsidy is given
-            self.elevation_cost_diff = self.elevation_cost_old - self.elevation_cost
-            self.dryproofing_cost_diff = self.dryproofing_cost_old - self.dryproofing_cost
-            self.wetproofing_cost_diff = self.wetproofing_cost_old - self.wetproofing_cost
-    
-                
-        # Check whether the agent is adapted
-        implemented_measures = []
-        if self.is_adapted==True:
-            # check which measures implemented 
-            if self.is_elevated:
-                implemented_measures.append('elevation')
-            if self.is_dryproofed:
-                implemented_measures.append('dryproofing')
-            if self.is_wetproofed:
-                implemented_measures.append('wetproofing')
-
-            # Check expiration of dryproofing measure
-            if "dryproofing" in implemented_measures:
-                self.dryproofing_lifetime -= 1      # quarterly decrease (total life time 20 years, i.e. 80 quarters)
-                if self.dryproofing_lifetime == 0:
-                    # print("Agent {}'s dryproofing measure expired".format(self.unique_id))
-                    self.is_dryproofed = False
-                    self.measures_undergone.remove('dryproofing')
-                    # Reverse the effect of dryproofing
-                    self.flood_damage_estimated = self.flood_damage_estimated / (1-self.dryproofing_efficiency)
-                    self.flood_damage_actual = self.flood_damage_actual / (1-self.dryproofing_efficiency)
-                    implemented_measures.remove("dryproofing")
-                    # if no measure implemented except dryproofing, then the agent is not adapted
-                    if len(implemented_measures) == 0:
-                        self.is_adapted = False
+            # Recheck subsidy eligibility based on the new income and recalculate the costs with subsidy
+            self.apply_subsidy()
+            # the new income changes the priority of the household for the government
+            self.model.government.update_household(self)
+            self.schedule_death()
 
+        # Check expiration of dryproofing measure
+        if DRYPROOFING_EXPIRY in due_events:
+            # print("Agent {}'s dryproofing measure expired".format(self.unique_id))
+            self.is_dryproofed = False
+            self.measures_undergone.remove('dryproofing')
+            # Reverse the effect of dryproofing
+            self.flood_damage_estimated = self.flood_damage_estimated / (1-self.dryproofing_efficiency)
+            self.flood_damage_actual = self.flood_damage_actual / (1-self.dryproofing_efficiency)
+            # if no measure implemented except dryproofing, then the agent is not adapted
+            if len(self.measures_undergone) == 0:
+                self.is_adapted = False
+            # dryproofing is available again, so the household can be eligible for subsidy again
+            self.model.government.update_household(self)
 
         # check which measures are available/left to implement
-        available_measures = [measure for measure in ['elevation', 'dryproofing', 'wetproofing'] if measure not in implemented_measures]
+        available_measures = [measure for measure in ['elevation', 'dryproofing', 'wetproofing'] if measure not in self.measures_undergone]
         
 
         if len(available_measures) > 0: # there are still available measures to implement
@@ -269,7 +330,9 @@ class Households(Agent):
                     self.total_subsidy += self.elevation_cost_diff
                 if adaptation_choice == 'dryproofing':
                     self.is_dryproofed = True
-                    self.dryproofing_lifetime = 80
+                    # dry-proofing expires after 80 quarters
+                    self.dryproofing_expiry_tick = self.model.counter + 80
+                    self.model.event_calendar.schedule(self.dryproofing_expiry_tick, DRYPROOFING_EXPIRY, self.unique_id)
                     self.measures_undergone.append('dryproofing')
                     self.total_subsidy += self.dryproofing_cost_diff
                 if adaptation_choice == 'wetproofing':
@@ -287,6 +350,8 @@ class Households(Agent):
                 self.is_adapted = True
                 # keep track of the measure expenditure
                 self.measure_expenditure += adaptation_cost
+                # the adaptation changes the subsidy eligibility and flood risk of the household
+                self.model.government.update_household(self)
 
         # calculate the estimated reduced damage (if no measure implemented reduced damage is zero)
         # it adds on it in every step (so it is cumulative)
@@ -300,12 +365,159 @@ class Households(Agent):
 # Define the Government agent class
 class Government(Agent):
     """
-    A government agent that currently doesn't perform any actions.
+    A government agent that allocates a limited quarterly subsidy budget to eligible households.
+    Without a budget (government_budget is None) the government doesn't perform any actions and
+    all eligible households get the subsidy rate as a flat discount on their measure costs.
+
+    With a budget, households with an income below the threshold and at least one measure left to implement
+    are kept in a priority queue (heap), ordered by income (lowest first) or flood risk (highest estimated
+    damage first). The queue is updated incrementally when the income of a household changes (death/renewal)
+    or when it adapts; outdated entries are skipped when they are popped. Each step the government offers the
+    subsidy rate to households in priority order as long as the budget allows, which costs O(k log N) for
+    k popped households instead of a scan over the population. For every offer the government reserves the
+    subsidy the household would actually claim (see expected_claim). Households that wouldn't implement any
+    measure with the subsidy, or whose claim doesn't fit in the remaining budget, are passed over (they keep
+    their place in the queue) and the next household is tried.
     """
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
+        self.budget = self.model.government_budget # quarterly subsidy budget (None means flat subsidy)
+        self.priority = self.model.subsidy_priority # "income" or "flood_risk"
+        if self.priority not in ['income', 'flood_risk']:
+            raise ValueError(f"Unknown subsidy priority: '{self.priority}'. "
+                             f"Currently implemented priorities are: 'income' and 'flood_risk'")
+        self.households = {} # households by unique id
+        self.queue = [] # heap of (priority key, unique id, version) entries of eligible households
+        self.versions = {} # latest version of the queue entry per household, older entries are outdated
+        self.eligible = set() # unique ids of the currently eligible households
+        self.offers = {} # households with a subsidy offer in this step: unique id -> total subsidy at the offer
+        self.subsidised_households = set() # unique ids of the households that received a subsidy
+
+        # data collection
+        self.quarterly_spending = 0 # subsidy paid in this step
+        self.total_spending = 0 # subsidy paid over all steps
+        self.quarterly_offers = 0 # number of subsidy offers in this step
+
+        for agent in self.model.schedule.agents:
+            if isinstance(agent, Households):
+                self.households[agent.unique_id] = agent
+                self.update_household(agent)
+
+    def is_eligible(self, household):
+        """A household is eligible for subsidy if its income is below the threshold and it has measures left to implement."""
+        return household.income <= self.model.income_threshold and len(household.measures_undergone) < 3
+
+    def priority_key(self, household):
+        """Return the priority of a household, the household with the lowest key gets the subsidy first."""
+        if self.priority == 'income':
+            return household.income
+        return -household.flood_damage_estimated
+
+    def update_household(self, household):
+        """Update the queue entry of a household after its income or adaptation status has changed."""
+        if self.budget is None:
+            return
+        # invalidate the current entry of the household
+        version = self.versions.get(household.unique_id, 0) + 1
+        self.versions[household.unique_id] = version
+        if self.is_eligible(household):
+            self.eligible.add(household.unique_id)
+            heapq.heappush(self.queue, (self.priority_key(household), household.unique_id, version))
+        else:
+            self.eligible.discard(household.unique_id)
+        # rebuild the queue when it contains too many outdated entries
+        if len(self.queue) > 2 * len(self.households) + 100:
+            self.queue = [entry for entry in self.queue if self.versions.get(entry[1]) == entry[2]]
+            heapq.heapify(self.queue)
+
+    def expected_claim(self, household):
+        """
+        Return the highest subsidy a household would claim in this step if it got an offer.
+        The household decides with calculate_EU after saving (Households.step), so its choice with the subsidised
+        costs is evaluated for every amount of savings it can have after saving. Only a measure it would actually
+        implement counts, so households that decline the subsidy don't hold on to the budget.
+        Dry-proofing that expires in this step counts as available, since the household drops it before deciding.
+        A household that dies in this step doesn't claim (the new household starts without subsidy).
+        """
+        due_events = self.model.due_events.get(household.unique_id, ())
+        if DEATH in due_events:
+            return 0
+        measures_undergone = list(household.measures_undergone)
+        flood_damage_estimated = household.flood_damage_estimated
+        if DRYPROOFING_EXPIRY in due_events:
+            # the same update as in Households.step
+            measures_undergone.remove('dryproofing')
+            flood_damage_estimated = flood_damage_estimated / (1-household.dryproofing_efficiency)
+        # measure costs with subsidy, calculated as in Households.set_subsidy_rate
+        measures_info = {}
+        subsidies = {}
+        for measure in ['elevation', 'dryproofing', 'wetproofing']:
+            if measure in measures_undergone:
+                continue
+            cost_old = getattr(household, f'{measure}_cost_old')
+            cost = cost_old * (1-self.model.subsidy_rate)
+            measures_info[measure] = [cost, getattr(household, f'{measure}_efficiency')]
+            subsidies[measure] = cost_old - cost
+        if len(measures_info) == 0:
+            return 0
+        claim = 0
+        for savings in household.possible_savings():
+            choice = calculate_EU(savings, household.flood_probability, flood_damage_estimated, measures_info)['measure']
+            if choice != 'no_action':
+                claim = max(claim, subsidies[choice])
+        return claim
 
     def step(self):
-        # The government agent doesn't perform any actions.
-        pass
+        """
+        Offer the subsidy rate to eligible households in priority order. The expected claim of every offer
+        is reserved from the quarterly budget, so the budget is never exceeded. Households that wouldn't claim
+        a subsidy in this step, or whose claim doesn't fit in the remaining budget, are passed over and keep
+        their place in the queue.
+        """
+        self.quarterly_spending = 0
+        self.quarterly_offers = 0
+        if self.budget is None:
+            return
+        remaining_budget = self.budget
+        skipped = []
+        while self.queue and remaining_budget > 0:
+            key, unique_id, version = self.queue[0]
+            if self.versions.get(unique_id) != version:
+                # outdated entry
+                heapq.heappop(self.queue)
+                continue
+            heapq.heappop(self.queue)
+            household = self.households[unique_id]
+            reserved = self.expected_claim(household)
+            if reserved == 0 or reserved > remaining_budget:
+                # the household wouldn't adapt with the subsidy or its claim doesn't fit in the remaining budget
+                skipped.append((key, unique_id, version))
+                continue
+            remaining_budget -= reserved
+            household.set_subsidy_rate(self.model.subsidy_rate)
+            self.offers[unique_id] = household.total_subsidy
+            self.quarterly_offers += 1
+        # households that were passed over get their entry back
+        for entry in skipped:
+            heapq.heappush(self.queue, entry)
+
+    def settle(self):
+        """After the households have stepped, pay the claimed subsidies and withdraw the offers."""
+        for unique_id, total_subsidy_at_offer in self.offers.items():
+            household = self.households[unique_id]
+            paid = household.total_subsidy - total_subsidy_at_offer
+            if paid > 0:
+                self.quarterly_spending += paid
+                self.subsidised_households.add(unique_id)
+            household.set_subsidy_rate(0)
+            # the household gets a new entry if it is still eligible
+            self.update_household(household)
+        self.total_spending += self.quarterly_spending
+        self.offers = {}
 
+    def subsidy_coverage(self):
+        """Return the share of the eligible households that got a subsidy offer in this step."""
+        number_eligible = len(self.eligible)
+        if number_eligible == 0:
+            return 0
+        return self.quarterly_offers / number_eligible
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Event calendar for the household lifecycle in the Flood Adaptation Model.
+
+Death/renewal and the expiry of dry-proofing are deterministic future events, so they are scheduled
+when they are created (at moving in and at implementing dry-proofing) instead of being checked by
+every household in every step. Each step only the households with events due are processed.
+"""
+import heapq
+
+# lifecycle events of households
+DEATH = 'death'
+DRYPROOFING_EXPIRY = 'dryproofing_expiry'
+
+
+class EventCalendar:
+    """
+    Priority queue of scheduled household events, keyed by the tick in which they are due.
+    """
+    def __init__(self):
+        self.queue = [] # heap of (tick, sequence number, event, unique id) entries
+        self.sequence_number = 0 # keeps events with the same tick in order of scheduling
+
+    def schedule(self, tick, event, unique_id):
+        """Schedule an event for the household with the given unique id in the given tick."""
+        heapq.heappush(self.queue, (tick, self.sequence_number, event, unique_id))
+        self.sequence_number += 1
+
+    def pop_due(self, tick):
+        """
+        Remove and return the events that are due in the given tick (or earlier).
+
+        Returns
+        -------
+        due_events: dict with the set of due events per household unique id
+        """
+        due_events = {}
+        while self.queue and self.queue[0][0] <= tick:
+            _, _, event, unique_id = heapq.heappop(self.queue)
+            due_events.setdefault(unique_id, set()).add(event)
+        return due_events
+
+    def __len__(self):
+        return len(self.queue)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Regression harness for the Flood Adaptation Model.
+
+Golden fingerprints pin the behaviour of the model for a matrix of seeds and parameter sets:
+the per-step model reporter series and the final states of the household agents.
+Any alternative engine or code path (e.g. an optimized Households.step or calculate_EU) can be
+checked against them, and the first diverging tick and variable is reported.
+
+Usage (from the model directory):
+    python fingerprint.py record   # record the golden fingerprints with the current code
+    python fingerprint.py check    # check the current code against the golden fingerprints
+"""
+import hashlib
+import json
+import math
+import sys
+
+from model import AdaptationModel
+
+# path of the golden fingerprints file
+golden_path = r'../output/golden_fingerprints.json'
+
+# run length covering all three actual flood events (quarters 20, 80 and 200)
+DEFAULT_RUN_LENGTH = 220
+DEFAULT_SEEDS = [0, 1, 2]
+# matrix of parameter sets, the first one is the baseline of the sensitivity analysis
+DEFAULT_PARAMETER_SETS = [
+    {'number_of_households': 50, 'subsidy_rate': 0.5, 'income_threshold': 4000, 'saving_threshold': 0.5, 'harvey_probability': 0.07},
+    {'number_of_households': 50, 'subsidy_rate': 0, 'income_threshold': 2000, 'saving_threshold': 0.25, 'harvey_probability': 0.07},
+    {'number_of_households': 50, 'subsidy_rate': 1, 'income_threshold': 12000, 'saving_threshold': 0, 'harvey_probability': 0.3},
+    {'number_of_households': 50, 'subsidy_rate': 0.5, 'income_threshold': 4000, 'saving_threshold': 0.5, 'harvey_probability': 0.07,
+     'network': 'watts_strogatz'},
+    {'number_of_households': 50, 'subsidy_rate': 0.5, 'income_threshold': 6000, 'saving_threshold': 0.5, 'harvey_probability': 0.07,
+     'government_budget': 20000, 'subsidy_priority': 'income'},
+]
+# parameter sets with a government budget, checked for never spending more than the quarterly budget
+# and for actually paying out subsidies
+BUDGET_PARAMETER_SETS = [
+    {'number_of_households': 50, 'subsidy_rate': 0.5, 'income_threshold': 6000, 'saving_threshold': 0.5, 'harvey_probability': 0.07,
+     'government_budget': 20000, 'subsidy_priority': 'income'},
+    {'number_of_households': 50, 'subsidy_rate': 1, 'income_threshold': 12000, 'saving_threshold': 0, 'harvey_probability': 0.3,
+     'government_budget': 10000, 'subsidy_priority': 'flood_risk'},
+]
+
+# final household attributes that are part of the fingerprint
+AGENT_STATE_ATTRIBUTES = ['age', 'income', 'savings', 'is_adapted', 'is_elevated', 'is_dryproofed', 'is_wetproofed',
+                          'dryproofing_lifetime', 'measures_undergone', 'flood_damage_estimated', 'flood_damage_actual',
+                          'actual_damage', 'reduced_actual_damage', 'reduced_estimated_damage', 'measure_expenditure',
+                          'total_subsidy']
+
+
+def to_builtin(value):
+    """Convert numpy and other values to JSON serializable python values."""
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [to_builtin(item) for item in value]
+    if hasattr(value, 'dtype') and value.dtype.kind == 'b':
+        return bool(value)
+    return float(value)
+
+
+def run_fingerprint(parameters, seed, run_length=DEFAULT_RUN_LENGTH, model_factory=AdaptationModel):
+    """
+    Run the model and record its fingerprint.
+
+    Parameters
+    ----------
+    parameters: dict with the keyword arguments for the model (without the seed)
+    seed: seed of the run
+    run_length: number of steps to run
+    model_factory: class or function creating the model, to check alternative engines
+
+    Returns
+    -------
+    fingerprint: dict with the per-step model reporter series ('model') and the final household states ('agents')
+    """
+    model = model_factory(seed=seed, **parameters)
+    for tick in range(run_length):
+        model.step()
+    model_data = model.datacollector.get_model_vars_dataframe()
+    model_series = {variable: [to_builtin(value) for value in model_data[variable]] for variable in model_data.columns}
+    agent_states = {}
+    for agent in model.schedule.agents:
+        agent_states[str(agent.unique_id)] = {attribute: to_builtin(getattr(agent, attribute, None))
+                                              for attribute in AGENT_STATE_ATTRIBUTES}
+    return {'model': model_series, 'agents': agent_states}
+
+
+def round_value(value, significant_digits):
+    """Round numeric values to a number of significant digits, so that the hash tolerates tiny numeric differences."""
+    if isinstance(value, list):
+        return [round_value(item, significant_digits) for item in value]
+    if isinstance(value, bool) or not isinstance(value, float):
+        return value
+    if value == 0 or not math.isfinite(value):
+        return value
+    return round(value, significant_digits - 1 - int(math.floor(math.log10(abs(value)))))
+
+
+def fingerprint_hash(fingerprint, significant_digits=8):
+    """
+    Return the sha256 hash of a fingerprint with all numeric values rounded to significant digits.
+    The hash is a compact identifier of a recorded case, it is not used to decide whether runs match:
+    the rounding is much looser than the tolerances of compare_fingerprints.
+    """
+    rounded = {'model': {variable: round_value(series, significant_digits) for variable, series in fingerprint['model'].items()},
+               'agents': {unique_id: {attribute: round_value(value, significant_digits) for attribute, value in state.items()}
+                          for unique_id, state in fingerprint['agents'].items()}}
+    return hashlib.sha256(json.dumps(rounded, sort_keys=True).encode()).hexdigest()
+
+
+def values_match(expected, actual, rtol, atol):
+    """Compare two fingerprint values, numbers within tolerance and anything else exactly."""
+    if isinstance(expected, list) and isinstance(actual, list):
+        return len(expected) == len(actual) and all(values_match(e, a, rtol, atol) for e, a in zip(expected, actual))
+    if isinstance(expected, float) and isinstance(actual, float):
+        if math.isnan(expected) or math.isnan(actual):
+            return math.isnan(expected) and math.isnan(actual)
+        return abs(expected - actual) <= atol + rtol * abs(expected)
+    return expected == actual
+
+
+def compare_fingerprints(reference, candidate, rtol=1e-9, atol=1e-6):
+    """
+    Compare a candidate fingerprint with a reference fingerprint.
+
+    Returns
+    -------
+    divergence: None if the fingerprints match, otherwise a dict with the first diverging 'tick'
+                (or 'final' for the agent states), 'variable', 'expected' and 'actual' value
+    """
+    missing = set(reference['model']) ^ set(candidate['model'])
+    if missing:
+        return {'tick': None, 'variable': sorted(missing)[0], 'expected': None, 'actual': None}
+    run_length = len(next(iter(reference['model'].values()), []))
+    for tick in range(run_length):
+        for variable in sorted(reference['model']):
+            expected = reference['model'][variable][tick] if tick < len(reference['model'][variable]) else None
+            actual = candidate['model'][variable][tick] if tick < len(candidate['model'][variable]) else None
+            if not values_match(expected, actual, rtol, atol):
+                return {'tick': tick, 'variable': variable, 'expected': expected, 'actual': actual}
+    for unique_id in sorted(reference['agents'], key=int):
+        for attribute, expected in reference['agents'][unique_id].items():
+            actual = candidate['agents'].get(unique_id, {}).get(attribute)
+            if not values_match(expected, actual, rtol, atol):
+                return {'tick': 'final', 'variable': f'agent {unique_id}: {attribute}', 'expected': expected, 'actual': actual}
+    return None
+
+
+def record_golden_fingerprints(path=golden_path, seeds=DEFAULT_SEEDS, parameter_sets=DEFAULT_PARAMETER_SETS,
+                               run_length=DEFAULT_RUN_LENGTH, model_factory=AdaptationModel):
+    """Run the matrix of seeds and parameter sets and save their fingerprints as the golden reference."""
+    cases = []
+    for parameters in parameter_sets:
+        for seed in seeds:
+            fingerprint = run_fingerprint(parameters, seed, run_length, model_factory)
+            cases.append({'parameters': parameters, 'seed': seed, 'run_length': run_length,
+                          'hash': fingerprint_hash(fingerprint), 'fingerprint': fingerprint})
+    with open(path, 'w') as file:
+        json.dump(cases, file)
+    return cases
+
+
+def check_against_golden(path=golden_path, model_factory=AdaptationModel, rtol=1e-9, atol=1e-6):
+    """
+    Check a model engine against the golden fingerprints.
+
+    Parameters
+    ----------
+    path: path of the golden fingerprints file
+    model_factory: class or function creating the model (the engine that is checked)
+    rtol, atol: relative and absolute tolerance for numeric values
+
+    Returns
+    -------
+    divergences: list with a report for every diverging case (empty if everything matches)
+    """
+    with open(path) as file:
+        cases = json.load(file)
+    divergences = []
+    for case in cases:
+        fingerprint = run_fingerprint(case['parameters'], case['seed'], case['run_length'], model_factory)
+        # always compare the values, equal hashes could hide differences beyond rtol and atol
+        divergence = compare_fingerprints(case['fingerprint'], fingerprint, rtol, atol)
+        if divergence is not None:
+            divergence.update({'parameters': case['parameters'], 'seed': case['seed']})
+            divergences.append(divergence)
+    return divergences
+
+
+def check_government_budget(seeds=DEFAULT_SEEDS, parameter_sets=BUDGET_PARAMETER_SETS, run_length=DEFAULT_RUN_LENGTH,
+                            model_factory=AdaptationModel):
+    """
+    Check that the government never spends more than its quarterly budget and that it pays out subsidies.
+
+    Returns
+    -------
+    violations: list with a report for every tick in which the spending exceeds the budget, and for every parameter
+                set without any subsidy paid over all seeds (seed and tick None), empty if none
+    """
+    violations = []
+    for parameters in parameter_sets:
+        total_spending = 0
+        for seed in seeds:
+            model = model_factory(seed=seed, **parameters)
+            for tick in range(run_length):
+                model.step()
+            spending = model.datacollector.get_model_vars_dataframe()['government_spending']
+            for tick, value in enumerate(spending):
+                if value > parameters['government_budget']:
+                    violations.append({'parameters': parameters, 'seed': seed, 'tick': tick, 'spending': float(value)})
+            total_spending += spending.sum()
+        # a budget that is never spent is as broken as one that is exceeded
+        # (in a single seed no household may adapt at all, so the spending is summed over the seeds)
+        if total_spending == 0:
+            violations.append({'parameters': parameters, 'seed': None, 'tick': None, 'spending': 0.0})
+    return violations
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'record':
+        cases = record_golden_fingerprints()
+        print(f"Recorded {len(cases)} golden fingerprints in {golden_path}")
+    else:
+        divergences = check_against_golden()
+        for divergence in divergences:
+            print(f"Seed {divergence['seed']} with {divergence['parameters']} diverges at tick {divergence['tick']} "
+                  f"in {divergence['variable']}: expected {divergence['expected']}, got {divergence['actual']}")
+        violations = check_government_budget()
+        for violation in violations:
+            if violation['tick'] is None:
+                print(f"{violation['parameters']} doesn't pay out any subsidy in any seed")
+            else:
+                print(f"Seed {violation['seed']} with {violation['parameters']} spends {violation['spending']} "
+                      f"at tick {violation['tick']}, more than the government budget")
+        if divergences or violations:
+            sys.exit(1)
+        print("All runs match the golden fingerprints and the government pays out subsidies within its budget")
@@ -8,8 +8,13 @@ Functions get called by the Model and Agent class.
 import random
 import numpy as np
 import math
+import glob
+import hashlib
+import os
+import pickle
 from shapely import contains_xy
 from shapely import prepare
+from shapely.geometry import box
 import geopandas as gpd
 
 def set_initial_values(input_data, parameter, seed):
@@ -83,6 +88,152 @@ floodplain_geoseries = floodplain_gdf['geometry']
 floodplain_multipolygon = floodplain_geoseries[0]  # The geoseries contains only one multipolygon
 prepare(floodplain_multipolygon)
 
+input_data_path = r'../input_data'
+# directory with the model code, its source files define the code version
+code_path = os.path.dirname(os.path.abspath(__file__))
+
+# checksums of files already hashed in this session, keyed by path and stored with (modification time, size)
+_file_checksums = {}
+
+def file_checksum(path):
+    """
+    Get the sha256 checksum of a file. Checksums are kept in memory as long as the file does not change.
+
+    Parameters
+    ----------
+    path: path of the file
+
+    Returns
+    -------
+    checksum: hex digest of the file content
+    """
+    stat = os.stat(path)
+    if path in _file_checksums and _file_checksums[path][:2] == (stat.st_mtime, stat.st_size):
+        return _file_checksums[path][2]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(block)
+    _file_checksums[path] = (stat.st_mtime, stat.st_size, sha.hexdigest())
+    return sha.hexdigest()
+
+def input_data_checksum(path=input_data_path):
+    """
+    Get a combined checksum of all files in the input data directory (flood maps, model domain, floodplain).
+    Used to invalidate cached runs and populations when the input data changes.
+    """
+    sha = hashlib.sha256()
+    for root, _, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            sha.update(os.path.relpath(file_path, path).encode())
+            sha.update(file_checksum(file_path).encode())
+    return sha.hexdigest()
+
+def code_version(path=code_path):
+    """
+    Get a checksum of the python source files of the model.
+    Used to invalidate cached runs and populations when the code changes.
+    """
+    sha = hashlib.sha256()
+    for file_path in sorted(glob.glob(os.path.join(path, '*.py'))):
+        sha.update(os.path.basename(file_path).encode())
+        sha.update(file_checksum(file_path).encode())
+    return sha.hexdigest()
+
+def load_pickle_file(file_path):
+    """
+    Load a pickled cache entry and mark it as recently used (see evict_least_recently_used).
+    Returns None if the file doesn't exist or is incomplete.
+    """
+    try:
+        with open(file_path, 'rb') as file:
+            content = pickle.load(file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    # another process may have evicted the file after it was loaded
+    try:
+        os.utime(file_path)
+    except FileNotFoundError:
+        pass
+    return content
+
+def save_pickle_file(file_path, content):
+    """Pickle a cache entry, replacing the file atomically so that parallel processes never read a partially written file."""
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        pickle.dump(content, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, file_path)
+
+def evict_least_recently_used(path, max_size):
+    """Remove the least recently used pickle files in a cache directory until it fits within its maximum size in bytes."""
+    entries = []
+    for file_path in glob.glob(os.path.join(path, '*.pkl')):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, file_path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def generate_grid_zones(zone_grid_size):
+    """
+    Divide the model domain into a regular grid of flood zones.
+    The grid spans the bounding box of the model domain and each cell is clipped to the domain polygon.
+    Cells that fall completely outside the model domain are dropped.
+
+    Parameters
+    ----------
+    zone_grid_size: number of zones along each axis (zone_grid_size x zone_grid_size cells)
+
+    Returns
+    -------
+    zones_gdf: GeoDataFrame with a 'zone_id' column and one polygon per zone
+    """
+    cell_width = (map_maxx - map_minx) / zone_grid_size
+    cell_height = (map_maxy - map_miny) / zone_grid_size
+    zone_ids = []
+    zone_polygons = []
+    for row in range(zone_grid_size):
+        for col in range(zone_grid_size):
+            cell = box(map_minx + col * cell_width, map_miny + row * cell_height,
+                       map_minx + (col + 1) * cell_width, map_miny + (row + 1) * cell_height)
+            zone = cell.intersection(map_domain_polygon)
+            if not zone.is_empty:
+                zone_ids.append(row * zone_grid_size + col)
+                zone_polygons.append(zone)
+    zones_gdf = gpd.GeoDataFrame({'zone_id': zone_ids}, geometry=zone_polygons, crs=map_domain_gdf.crs)
+    return zones_gdf
+
+def load_zone_polygons(zone_path):
+    """
+    Load flood zones from a polygon shapefile. Every polygon in the file becomes one zone.
+
+    Parameters
+    ----------
+    zone_path: path to the shapefile containing the zone polygons
+
+    Returns
+    -------
+    zones_gdf: GeoDataFrame with a 'zone_id' column and one polygon per zone, in the model's crs
+    """
+    zones_gdf = gpd.GeoDataFrame.from_file(zone_path)
+    zones_gdf = zones_gdf.to_crs(epsg=26915)
+    zones_gdf = zones_gdf.reset_index(drop=True)
+    zones_gdf['zone_id'] = zones_gdf.index
+    return zones_gdf
+
 def generate_random_location_within_map_domain():
     """
     Generate random location coordinates within the map domain polygon.
@@ -163,6 +314,25 @@ def calculate_basic_flood_damage(flood_depth):
         flood_damage = 0.1746 * math.log(flood_depth) + 0.6483
     return flood_damage
 
+def calculate_basic_flood_damage_array(flood_depth):
+    """
+    Vectorized version of calculate_basic_flood_damage for an array of flood depths.
+
+    Parameters
+    ----------
+    flood_depth : array of flood depths
+
+    Returns
+    -------
+    flood_damage : array of damage factors between 0 and 1
+    """
+    flood_depth = np.asarray(flood_depth, dtype=float)
+    # the logarithm is only used for depths between 0.025 and 6m, clip to avoid log(0)
+    flood_damage = 0.1746 * np.log(np.clip(flood_depth, 0.025, 6)) + 0.6483
+    flood_damage = np.where(flood_depth < 0.025, 0, flood_damage)
+    flood_damage = np.where(flood_depth >= 6, 1, flood_damage)
+    return flood_damage
+
 # EU is the given RBB to Group 3. It is coded in functions to demonstrate its separatability from the rest.
 def calculate_EU(savings, flood_probability, flood_damage, measure_information):
     """
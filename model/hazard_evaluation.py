@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo evaluation of flood hazard timelines against recorded adaptation trajectories.
+
+In a model run the actual damage comes from a single flood timeline (floods in quarters 20, 80 and 200).
+This module scores many sampled flood timelines and depth multipliers against the savings and adaptation
+of the households recorded in a run (AdaptationModel(record_trajectories=True)), in vectorized batches,
+and returns damage distributions, tail metrics and the expected annual damage.
+
+The flood probability and, for local flooding, the flood zones are taken from the recorded run, so every
+scenario is scored with its own hazard: with zones only the households in the struck zones are hit by a flood.
+
+Note: the behaviour of the households is taken from the recorded run, so the sampled floods don't
+change the savings or adaptation decisions afterwards (no feedback). The recorded savings include the
+losses of the floods of the run itself.
+
+Usage (from the model directory):
+    model = AdaptationModel(seed=0, record_trajectories=True, ...)
+    for tick in range(run_length):
+        model.step()
+    result = evaluate_hazard_timelines(model.get_adaptation_trajectory(), number_of_timelines=10000, seed=0)
+    result['metrics']
+"""
+import numpy as np
+import pandas as pd
+
+from functions import calculate_basic_flood_damage_array
+
+
+def quarterly_probability(annual_probability):
+    """Return the probability of a flood in a quarter given the annual flood probability."""
+    return 1 - (1 - annual_probability) ** 0.25
+
+
+def sample_flood_timelines(number_of_timelines, number_of_ticks, flood_probability, rng):
+    """
+    Sample flood timelines: in every quarter a flood occurs independently with the quarterly probability.
+
+    Parameters
+    ----------
+    number_of_timelines: number of timelines to sample
+    number_of_ticks: number of quarters per timeline
+    flood_probability: annual flood probability
+    rng: numpy random generator
+
+    Returns
+    -------
+    timelines: boolean array (timelines, quarters), True when a flood occurs
+    """
+    return rng.random((number_of_timelines, number_of_ticks)) < quarterly_probability(flood_probability)
+
+
+def sample_flooded_households(number_of_floods, household_zone, number_of_zones, number_of_flooded_zones, rng):
+    """
+    Sample which households are hit in each flood with local flooding, like AdaptationModel.get_flooded_households:
+    in every flood a number of zones is struck at random and only the households in those zones are hit.
+
+    Parameters
+    ----------
+    number_of_floods: number of floods
+    household_zone: index of the zone of every household (-1 for households outside all zones)
+    number_of_zones: number of zones
+    number_of_flooded_zones: number of zones struck in each flood
+    rng: numpy random generator
+
+    Returns
+    -------
+    hit: boolean array (floods, households), True when the household is hit
+    """
+    number_struck = min(number_of_flooded_zones, number_of_zones)
+    # a random permutation of the zones per flood, the first zones are struck
+    struck_zones = np.argsort(rng.random((number_of_floods, number_of_zones)), axis=1)[:, :number_struck]
+    # one extra column for households outside all zones, which are never hit
+    struck = np.zeros((number_of_floods, number_of_zones + 1), dtype=bool)
+    np.put_along_axis(struck, struck_zones, True, axis=1)
+    return struck[:, household_zone]
+
+
+def damage_metrics(total_damage, number_of_years, quantiles=(0.9, 0.95, 0.99)):
+    """
+    Summarize a damage distribution.
+
+    Parameters
+    ----------
+    total_damage: array with the total damage of every timeline
+    number_of_years: length of the timelines in years
+    quantiles: quantiles for the value at risk and expected shortfall
+
+    Returns
+    -------
+    metrics: dict with the mean, standard deviation, expected annual damage, probability of any damage,
+             and the value at risk (quantile) and expected shortfall (mean beyond the quantile) per quantile
+    """
+    metrics = {'mean': float(np.mean(total_damage)),
+               'std': float(np.std(total_damage)),
+               'expected_annual_damage': float(np.mean(total_damage)) / number_of_years,
+               'probability_of_damage': float(np.mean(total_damage > 0))}
+    for quantile in quantiles:
+        value_at_risk = float(np.quantile(total_damage, quantile))
+        metrics[f'value_at_risk_{quantile}'] = value_at_risk
+        metrics[f'expected_shortfall_{quantile}'] = float(np.mean(total_damage[total_damage >= value_at_risk]))
+    return metrics
+
+
+def evaluate_hazard_timelines(trajectory, number_of_timelines=1000, flood_probability=None, depth_multiplier_range=(0.5, 1.2),
+                              quantiles=(0.9, 0.95, 0.99), batch_size=1000, max_elements=10_000_000, seed=None):
+    """
+    Score sampled flood timelines against a recorded adaptation trajectory.
+    For every flood the actual depth of each household is a random number between the bounds of
+    depth_multiplier_range times its estimated depth, like the actual floods in the model.
+
+    Parameters
+    ----------
+    trajectory: recorded trajectory of a run (see AdaptationModel.get_adaptation_trajectory)
+    number_of_timelines: number of flood timelines to sample
+    flood_probability: annual flood probability, by default the flood probability of the recorded run
+    depth_multiplier_range: (low, high) bounds of the multiplier on the estimated flood depth
+    quantiles: quantiles for the tail metrics
+    batch_size: number of timelines sampled at once
+    max_elements: maximum number of (flood, household) values evaluated at once, bounds the memory use
+    seed: seed of the random generator
+
+    Returns
+    -------
+    result: dict with per timeline arrays of the 'total_damage' (with adaptation), the 'total_damage_without_adaptation',
+            the 'total_reduced_damage' and the 'number_of_floods', and the 'metrics' of the damage distributions
+    """
+    if trajectory['savings'].ndim != 2 or len(trajectory['savings']) < 2:
+        raise ValueError("The trajectory contains no recorded steps. Run the model with record_trajectories=True "
+                         "for at least one step.")
+    if flood_probability is None:
+        flood_probability = trajectory['flood_probability']
+    # with flood zones only the households in the struck zones are hit (local flooding)
+    zone_ids = trajectory.get('zone_ids')
+    local_flooding = zone_ids is not None
+
+    rng = np.random.default_rng(seed)
+    # the last row is the state after the last step, a flood there would happen after the run
+    savings = trajectory['savings'][:-1]
+    damage_multiplier = trajectory['damage_multiplier'][:-1]
+    flood_depth = trajectory['flood_depth_estimated']
+    number_of_ticks, number_of_households = savings.shape
+    low, high = depth_multiplier_range
+
+    total_damage = np.zeros(number_of_timelines)
+    total_damage_without_adaptation = np.zeros(number_of_timelines)
+    number_of_floods = np.zeros(number_of_timelines, dtype=int)
+    # number of floods evaluated at once
+    events_per_chunk = max(1, max_elements // max(1, number_of_households))
+
+    for batch_start in range(0, number_of_timelines, batch_size):
+        batch_end = min(batch_start + batch_size, number_of_timelines)
+        timelines = sample_flood_timelines(batch_end - batch_start, number_of_ticks, flood_probability, rng)
+        timeline_index, tick_index = np.nonzero(timelines)
+        timeline_index += batch_start
+        number_of_floods[batch_start:batch_end] = timelines.sum(axis=1)
+        for chunk_start in range(0, len(tick_index), events_per_chunk):
+            chunk_timelines = timeline_index[chunk_start:chunk_start + events_per_chunk]
+            chunk_ticks = tick_index[chunk_start:chunk_start + events_per_chunk]
+            # actual flood depth and damage factor of every household in every flood (floods, households)
+            depth_multiplier = rng.uniform(low, high, size=(len(chunk_ticks), number_of_households))
+            flood_damage = calculate_basic_flood_damage_array(depth_multiplier * flood_depth)
+            if local_flooding:
+                flood_damage = flood_damage * sample_flooded_households(len(chunk_ticks), trajectory['zone'], len(zone_ids),
+                                                                        trajectory['number_of_flooded_zones'], rng)
+            damage_without_adaptation = flood_damage * savings[chunk_ticks]
+            damage = damage_without_adaptation * damage_multiplier[chunk_ticks]
+            np.add.at(total_damage_without_adaptation, chunk_timelines, damage_without_adaptation.sum(axis=1))
+            np.add.at(total_damage, chunk_timelines, damage.sum(axis=1))
+
+    total_reduced_damage = total_damage_without_adaptation - total_damage
+    number_of_years = number_of_ticks / 4
+    metrics = {'total_damage': damage_metrics(total_damage, number_of_years, quantiles),
+               'total_damage_without_adaptation': damage_metrics(total_damage_without_adaptation, number_of_years, quantiles),
+               'total_reduced_damage': damage_metrics(total_reduced_damage, number_of_years, quantiles)}
+    return {'total_damage': total_damage,
+            'total_damage_without_adaptation': total_damage_without_adaptation,
+            'total_reduced_damage': total_reduced_damage,
+            'number_of_floods': number_of_floods,
+            'metrics': metrics}
+
+
+def evaluate_scenarios(trajectories, **kwargs):
+    """
+    Evaluate the recorded trajectories of several scenarios with evaluate_hazard_timelines.
+
+    Parameters
+    ----------
+    trajectories: dict with the recorded trajectory per scenario name
+    kwargs: arguments for evaluate_hazard_timelines (e.g. number_of_timelines, seed). Without a flood_probability
+            every scenario is evaluated with the flood probability of its own recorded run
+
+    Returns
+    -------
+    dataframe: one row per scenario and damage type with the metrics of its damage distribution
+    """
+    rows = []
+    for scenario, trajectory in trajectories.items():
+        result = evaluate_hazard_timelines(trajectory, **kwargs)
+        for damage_type, metrics in result['metrics'].items():
+            rows.append({'scenario': scenario, 'damage_type': damage_type, **metrics})
+    return pd.DataFrame(rows)
@@ -5,6 +5,7 @@ from mesa.time import RandomActivation, BaseScheduler
 from mesa.space import NetworkGrid
 from mesa.datacollection import DataCollector
 import geopandas as gpd
+from shapely import STRtree
 import rasterio as rs
 import matplotlib.pyplot as plt
 import random
@@ -16,6 +17,14 @@ from agents import Households, Government
 # Import functions from functions.py
 from functions import get_flood_map_data, calculate_basic_flood_damage
 from functions import map_domain_gdf, floodplain_gdf
+from functions import generate_grid_zones, load_zone_polygons
+
+# Import the event calendar from events.py
+from events import EventCalendar
+
+# Import the population cache from population.py
+from population import population_key, load_population, save_population, create_population_snapshot
+from population import household_attributes
 
 
 # Define the AdaptationModel class
@@ -31,8 +40,20 @@ class AdaptationModel(Model):
                  income_threshold  = 2000, # monthly income threshold for subsidy eligibility,
                  saving_threshold = 0.25, # threshold for agents to save or consume
                  harvey_probability = 0.07, # probability of harvey flood
+                 # quarterly subsidy budget of the government. None for a flat subsidy to all eligible households
+                 government_budget = None,
+                 # order in which the government offers subsidies with a budget. Can currently be "income" or "flood_risk"
+                 subsidy_priority = 'income',
                  # Simplified argument for choosing flood map. Can currently be "harvey", "100yr", or "500yr".
                  flood_map_choice='harvey',
+                 # ### flood zone related parameters ###
+                 # Zones used for local flooding. None for global flooding (all households are flooded),
+                 # "grid" for a regular grid over the model domain, or a path to a shapefile with zone polygons
+                 flood_zones = None,
+                 # number of grid zones along each axis when flood_zones is "grid"
+                 zone_grid_size = 4,
+                 # number of zones that are struck in each flood event
+                 number_of_flooded_zones = 1,
                  # ### network related parameters ###
                  # The social network structure that is used.
                  # Can currently be "erdos_renyi", "barabasi_albert", "watts_strogatz", or "no_network"
@@ -42,7 +63,12 @@ class AdaptationModel(Model):
                  # number of edges for BA network
                  number_of_edges = 3,
                  # number of nearest neighbours for WS social network
-                 number_of_nearest_neighbours = 5
+                 number_of_nearest_neighbours = 5,
+                 # reuse the initial household population of earlier runs with the same seed (see population.py).
+                 # Snapshots are kept in memory and written to ../population_cache/ (size-bounded, oldest evicted first)
+                 population_cache = True,
+                 # record the savings and adaptation of every household in every step (see hazard_evaluation.py)
+                 record_trajectories = False
                  ):
         
         super().__init__(seed = seed)
@@ -58,17 +84,26 @@ class AdaptationModel(Model):
         self.subsidy_rate = subsidy_rate # subsidy rate given to households, between 0 and 1 (0% to 100%)
         self.income_threshold = income_threshold # income threshold defined for subsidy eligibility
         self.saving_threshold = saving_threshold # use this threshold for agents calculate_saving() function
+        self.government_budget = government_budget # quarterly subsidy budget (None means flat subsidy)
+        self.subsidy_priority = subsidy_priority # priority of households for subsidy offers within the budget
         # Add flood map choice to model attributes, so it can be accessed by agents
         self.map_choice = flood_map_choice  # Choice of flood map
         # flood probability for harvey
         self.harvey_probability = harvey_probability
 
+        # flood zones
+        self.flood_zones = flood_zones # Type of zones used for local flooding (None means global flooding)
+        self.zone_grid_size = zone_grid_size
+        self.number_of_flooded_zones = number_of_flooded_zones
+        self.flooded_zones = [] # zones struck in the latest flood event
 
         # network
         self.network = network # Type of network to be created
         self.probability_of_network_connection = probability_of_network_connection
         self.number_of_edges = number_of_edges
         self.number_of_nearest_neighbours = number_of_nearest_neighbours
+        self.population_cache = population_cache
+        self.record_trajectories = record_trajectories
 
         # generating the graph according to the network used and the network parameters specified
         self.G = self.initialize_network()
@@ -77,15 +112,19 @@ class AdaptationModel(Model):
 
         # Initialize maps
         self.initialize_maps(flood_map_choice)
+        # Initialize flood zones and their spatial index
+        self.initialize_zones()
 
         # set schedule for agents
         self.schedule = RandomActivation(self)  # Schedule for activating agents
+        # calendar of household lifecycle events (death and dry-proofing expiry), keyed by tick
+        self.event_calendar = EventCalendar()
+        self.due_events = {} # events due in the current step per household unique id
 
         # create households through initiating a household on each node of the network graph
-        for i, node in enumerate(self.G.nodes(),start=1):
-            household = Households(unique_id=i, model=self)
-            self.schedule.add(household)
-            self.grid.place_agent(agent=household, node_id=node)
+        self.initialize_households()
+        # create the government, it is not part of the schedule since it acts before and after the households
+        self.government = Government(unique_id=0, model=self)
 
         # Data collection setup to collect data
         model_metrics = {
@@ -102,6 +141,9 @@ class AdaptationModel(Model):
                         "total_subsidy": self.total_subsidy, # sum of all the subsidies given to households
                         "total_quarterly_damage": self.total_quarterly_damage, # total quarterly damage (absolute)
                         }
+        if self.government_budget is not None:
+            model_metrics["government_spending"] = self.government_spending # subsidy paid by the government per quarter
+            model_metrics["subsidy_coverage"] = self.subsidy_coverage # share of eligible households with a subsidy offer per quarter
         
         agent_metrics = {
                         #"FloodDepthEstimated": "flood_depth_estimated",
@@ -128,6 +170,12 @@ class AdaptationModel(Model):
         #set up the data collector 
         self.datacollector = DataCollector(model_reporters=model_metrics, agent_reporters=agent_metrics)
 
+        # trajectories of the households, recorded at the start and after every step
+        self.savings_trajectory = []
+        self.damage_multiplier_trajectory = []
+        if self.record_trajectories:
+            self.record_trajectory()
+
     def initialize_network(self):
         """
         Initialize and return the social network graph based on the provided network type using pattern matching.
@@ -179,6 +227,106 @@ class AdaptationModel(Model):
         self.band_flood_img, self.bound_left, self.bound_right, self.bound_top, self.bound_bottom = get_flood_map_data(
             self.flood_map)
 
+    def initialize_households(self):
+        """
+        Create a household on each node of the network graph.
+        The population only depends on the seed, the number of households and the flood map, so with the
+        population cache it is drawn once per seed and reused in every scenario: only the subsidy is applied
+        on top of it (by Households.apply_subsidy, like for drawn households). The random state after drawing
+        the population is restored, so the run is the same as without the cache.
+        """
+        # runs without a seed are not reproducible, so their population is never cached
+        use_cache = self.population_cache and self.seed is not None
+        snapshot = None
+        if use_cache:
+            key = population_key(self.seed, self.number_of_households, self.map_choice)
+            snapshot = load_population(key)
+
+        households = []
+        for i, node in enumerate(self.G.nodes(),start=1):
+            if snapshot is not None:
+                household = Households(unique_id=i, model=self, attributes=household_attributes(snapshot, i - 1))
+            else:
+                household = Households(unique_id=i, model=self)
+            households.append(household)
+            self.schedule.add(household)
+            self.grid.place_agent(agent=household, node_id=node)
+            # register the household in the zone that contains its location
+            self.assign_household_to_zone(household)
+
+        if snapshot is not None:
+            # continue with the random state as if the population was drawn
+            random.setstate(snapshot['random_state'])
+        elif use_cache:
+            save_population(key, create_population_snapshot(households, random.getstate()))
+
+    def initialize_zones(self):
+        """
+        Initialize the flood zones and a spatial index (STRtree) over the zone polygons.
+        Households are registered in their zone at placement, so that a flood event
+        only has to visit the households in the struck zones.
+        """
+        self.households_per_zone = {}
+        if self.flood_zones is None:
+            # global flooding, no zones needed
+            self.zones_gdf = None
+            self.zone_tree = None
+            return
+        if self.flood_zones == 'grid':
+            self.zones_gdf = generate_grid_zones(self.zone_grid_size)
+        else:
+            self.zones_gdf = load_zone_polygons(self.flood_zones)
+        self.zone_tree = STRtree(self.zones_gdf.geometry.values)
+        self.households_per_zone = {zone_id: [] for zone_id in self.zones_gdf['zone_id']}
+
+    def assign_household_to_zone(self, household):
+        """
+        Look up the zone that contains the household location in the spatial index and register the household in it.
+        Households outside all zones get zone_id None and are not hit by local flooding.
+        """
+        household.zone_id = None
+        if self.zone_tree is None:
+            return
+        zone_indices = self.zone_tree.query(household.location, predicate='intersects')
+        if len(zone_indices) > 0:
+            # a household on a shared border is assigned to the first zone only
+            household.zone_id = self.zones_gdf['zone_id'].iloc[min(zone_indices)]
+            self.households_per_zone[household.zone_id].append(household)
+
+    def get_flooded_households(self):
+        """
+        Return the households that are hit by a flood event.
+        With global flooding all households are hit, otherwise only the households in randomly struck zones.
+        """
+        if self.zone_tree is None:
+            return [agent for agent in self.schedule.agents if isinstance(agent, Households)]
+        zone_ids = list(self.households_per_zone.keys())
+        self.flooded_zones = random.sample(zone_ids, min(self.number_of_flooded_zones, len(zone_ids)))
+        return [household for zone_id in self.flooded_zones for household in self.households_per_zone[zone_id]]
+
+    def flood_household(self, agent):
+        """
+        Apply an actual flood to a household: draw the actual flood depth, calculate the
+        damage (reduced by the measures undergone) and update the savings of the household.
+        """
+        # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
+        agent.flood_depth_actual = random.uniform(0.5, 1.2) * agent.flood_depth_estimated
+        # calculate the actual flood damage given the actual flood depth
+        agent.flood_damage_actual = calculate_basic_flood_damage(agent.flood_depth_actual)
+        # before adaptation, keep track of the actual damage
+        agent.flood_damage_actual_old = agent.flood_damage_actual
+        # check for adaptation, and update the actual damage accordingly
+        # (the same multiplier is recorded for the hazard evaluation, see hazard_evaluation.py)
+        if agent.is_adapted:
+            agent.flood_damage_actual *= agent.damage_multiplier()
+
+        # keep count of the actual damage of the agent
+        agent.actual_damage += agent.flood_damage_actual * agent.savings
+        # keep count of the reduced damage
+        agent.reduced_actual_damage += (agent.flood_damage_actual_old-agent.flood_damage_actual)* agent.savings
+        # decrease the savings of the agent by the actual damage
+        agent.savings -= agent.flood_damage_actual * agent.savings
+
     def total_adapted_households(self):
         """Return the total number of households that have adapted."""
         #BE CAREFUL THAT YOU MAY HAVE DIFFERENT AGENT TYPES SO YOU NEED TO FIRST CHECK IF THE AGENT IS ACTUALLY A HOUSEHOLD AGENT USING "ISINSTANCE"
@@ -245,18 +393,64 @@ class AdaptationModel(Model):
         subsidy = sum([agent.total_subsidy for agent in self.schedule.agents if isinstance(agent, Households)])
         return subsidy
     
+    def government_spending(self):
+        """Return the subsidy paid by the government in this quarter (only with a government budget)."""
+        return self.government.quarterly_spending
+
+    def subsidy_coverage(self):
+        """Return the share of eligible households that got a subsidy offer in this quarter (only with a government budget)."""
+        return self.government.subsidy_coverage()
+
     def total_quarterly_damage(self):
         """Return the total quarterly damage."""
         total_quarterly_damage = sum([agent.quarter_damage for agent in self.schedule.agents if isinstance(agent, Households)])
         return total_quarterly_damage
        
 
+    def record_trajectory(self):
+        """Record the savings and damage multiplier (adaptation) of every household, in order of unique id."""
+        households = [agent for agent in self.schedule.agents if isinstance(agent, Households)]
+        self.savings_trajectory.append([household.savings for household in households])
+        self.damage_multiplier_trajectory.append([household.damage_multiplier() for household in households])
+
+    def get_adaptation_trajectory(self):
+        """
+        Return the recorded trajectories of the households (only with record_trajectories).
+        Row t of the trajectories is the state after t steps, i.e. the state in which a flood
+        at the start of step t+1 hits the households.
+
+        Returns
+        -------
+        trajectory: dict with the 'savings' and 'damage_multiplier' per step and household (steps + 1, households),
+                    the 'flood_depth_estimated', 'unique_id' and 'zone' (index in 'zone_ids', -1 outside all zones)
+                    per household, the annual 'flood_probability' of the households, and for local flooding the
+                    'zone_ids' and 'number_of_flooded_zones' ('zone_ids' is None for global flooding)
+        """
+        if not self.record_trajectories:
+            raise ValueError("No trajectories recorded. Create the model with record_trajectories=True "
+                             "to record the trajectories of the households.")
+        households = [agent for agent in self.schedule.agents if isinstance(agent, Households)]
+        zone_ids = list(self.households_per_zone.keys()) if self.zone_tree is not None else None
+        zone_index = {zone_id: index for index, zone_id in enumerate(zone_ids or [])}
+        return {'savings': np.array(self.savings_trajectory, dtype=float),
+                'damage_multiplier': np.array(self.damage_multiplier_trajectory, dtype=float),
+                'flood_depth_estimated': np.array([household.flood_depth_estimated for household in households], dtype=float),
+                'unique_id': np.array([household.unique_id for household in households]),
+                # all households share the flood probability of the chosen flood map
+                'flood_probability': households[0].flood_probability if households else None,
+                'zone_ids': zone_ids,
+                'zone': np.array([zone_index.get(household.zone_id, -1) for household in households], dtype=int),
+                'number_of_flooded_zones': self.number_of_flooded_zones}
+
     def plot_model_domain_with_agents(self):
         fig, ax = plt.subplots()
         # Plot the model domain
         map_domain_gdf.plot(ax=ax, color='lightgrey')
         # Plot the floodplain
         floodplain_gdf.plot(ax=ax, color='lightblue', edgecolor='k', alpha=0.5)
+        # Plot the flood zones (if any)
+        if self.zones_gdf is not None:
+            self.zones_gdf.boundary.plot(ax=ax, color='grey', linewidth=0.5)
 
         # Collect agent locations and statuses
         for agent in self.schedule.agents:
@@ -277,45 +471,27 @@ class AdaptationModel(Model):
     def step(self):
         """
         introducing a shock: 
-        at time step 5, there will be a global flooding.
+        at time steps 20, 80 and 200, there will be a flooding.
         This will result in actual flood depth. Here, we assume it is a random number
-        between 0.5 and 1.2 of the estimated flood depth. In your model, you can replace this
-        with a more sound procedure (e.g., you can devide the floop map into zones and 
-        assume local flooding instead of global flooding). The actual flood depth can be 
-        estimated differently
+        between 0.5 and 1.2 of the estimated flood depth. Without flood zones the flooding is global
+        and all households are hit. With flood zones (see flood_zones) the flooding is local and
+        only the households in the struck zones are hit.
         """
         self.counter += 1 # increase the counter by 1
+        # get the household lifecycle events that are due in this step
+        self.due_events = self.event_calendar.pop_due(self.counter)
         # actual flooding occurs in 5th, 20th and 50th years. So, 20th, 80th and 200th quarters.
         if self.schedule.steps == 20 or self.schedule.steps == 80  or self.schedule.steps == 200:
-            for agent in self.schedule.agents:
-                if isinstance(agent, Households):
-                    # Calculate the actual flood depth as a random number between 0.5 and 1.2 times the estimated flood depth
-                    agent.flood_depth_actual = random.uniform(0.5, 1.2) * agent.flood_depth_estimated
-                    # calculate the actual flood damage given the actual flood depth
-                    agent.flood_damage_actual = calculate_basic_flood_damage(agent.flood_depth_actual)
-                    # before adaptation, keep track of the actual damage
-                    agent.flood_damage_actual_old = agent.flood_damage_actual
-                    # check for adaptation, and update the actual damage accordingly
-                    if agent.is_adapted:
-                        for measure in agent.measures_undergone:
-                            if measure == 'elevation':
-                                agent.flood_damage_actual *= (1 - agent.elevation_efficiency)
-                            elif measure == 'dryproofing':
-                                agent.flood_damage_actual *= (1 - agent.dryproofing_efficiency)
-                            elif measure == 'wetproofing':
-                                agent.flood_damage_actual *= (1 - agent.wetproofing_efficiency)
-
-                    # keep count of the actual damage of the agent
-                    agent.actual_damage += agent.flood_damage_actual * agent.savings
-                    # keep count of the reduced damage
-                    agent.reduced_actual_damage += (agent.flood_damage_actual_old-agent.flood_damage_actual)* agent.savings
-                    # decrease the savings of the agent by the actual damage
-                    agent.savings -= agent.flood_damage_actual * agent.savings
+            for agent in self.get_flooded_households():
+                self.flood_household(agent)
  
+        # The government offers subsidies within its budget before the households decide
+        self.government.step()
         # Advance the model by one step
         self.schedule.step()
+        # The government pays the claimed subsidies
+        self.government.settle()
         # Collect data 
         self.datacollector.collect(self)
-        
-
-
+        if self.record_trajectories:
+            self.record_trajectory()
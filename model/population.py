@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of initial household populations for the Flood Adaptation Model.
+
+For a given seed the initial population drawn in Households.__init__ (ages, incomes, savings, measure costs,
+locations, floodplain membership and flood depths) is the same in every scenario. The population is stored
+as a snapshot, together with the state of the random number generator after drawing it, so that scenarios
+with the same seed only have to apply the scenario-dependent parts (subsidy eligibility) on top of it.
+Snapshots are kept in memory and on disk (../population_cache/), both bounded in size: the least recently
+used snapshots are evicted first.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from functions import input_data_checksum, code_version, load_pickle_file, save_pickle_file, evict_least_recently_used
+
+# default location of the population snapshots on disk (relative to the model directory)
+population_cache_path = r'../population_cache'
+# maximum number of snapshots kept in memory and maximum size of the snapshots on disk (500 MB)
+MAX_POPULATIONS_IN_MEMORY = 32
+MAX_POPULATION_CACHE_SIZE = 500 * 1024 ** 2
+
+# household attributes that do not depend on the scenario parameters
+POPULATION_ATTRIBUTES = ['age', 'income', 'savings_number', 'savings', 'in_floodplain', 'flood_depth_estimated']
+MEASURES = ['elevation', 'dryproofing', 'wetproofing']
+
+# snapshots already used in this session, keyed by population key, least recently used first
+_populations = OrderedDict()
+
+
+def population_key(seed, number_of_households, flood_map_choice):
+    """Return the key of a population: a hash of the seed, size, flood map, input data and code version."""
+    content = {'seed': seed,
+               'number_of_households': number_of_households,
+               'flood_map_choice': flood_map_choice,
+               'input_data': input_data_checksum(),
+               'code_version': code_version()}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def create_population_snapshot(households, random_state):
+    """
+    Create a population snapshot from newly created households.
+
+    Parameters
+    ----------
+    households: list of households in order of creation
+    random_state: state of the random module after the households were created
+
+    Returns
+    -------
+    snapshot: dict with a list of values per attribute, the locations and the random state
+    """
+    snapshot = {attribute: [getattr(household, attribute) for household in households] for attribute in POPULATION_ATTRIBUTES}
+    # measure costs before subsidy
+    for measure in MEASURES:
+        snapshot[f'{measure}_cost'] = [getattr(household, f'{measure}_cost_old') for household in households]
+    snapshot['x'] = [household.location.x for household in households]
+    snapshot['y'] = [household.location.y for household in households]
+    snapshot['random_state'] = random_state
+    return snapshot
+
+
+def load_population(key, path=population_cache_path):
+    """Return the population snapshot for a key from memory or disk, or None if it is not cached."""
+    if key in _populations:
+        _populations.move_to_end(key)
+        return _populations[key]
+    snapshot = load_pickle_file(os.path.join(path, f'{key}.pkl'))
+    if snapshot is None:
+        return None
+    remember_population(key, snapshot)
+    return snapshot
+
+
+def remember_population(key, snapshot):
+    """Keep a snapshot in memory, forgetting the least recently used snapshot when there are too many."""
+    _populations[key] = snapshot
+    _populations.move_to_end(key)
+    while len(_populations) > MAX_POPULATIONS_IN_MEMORY:
+        _populations.popitem(last=False)
+
+
+def save_population(key, snapshot, path=population_cache_path):
+    """Store a population snapshot in memory and on disk, and evict old snapshots if the cache is too large."""
+    remember_population(key, snapshot)
+    save_pickle_file(os.path.join(path, f'{key}.pkl'), snapshot)
+    evict_least_recently_used(path, MAX_POPULATION_CACHE_SIZE)
+
+
+def household_attributes(snapshot, index):
+    """
+    Return the initial attributes of a single household from a population snapshot.
+    The measure costs are without subsidy, Households.apply_subsidy applies the scenario on top.
+    """
+    attributes = {attribute: snapshot[attribute][index] for attribute in POPULATION_ATTRIBUTES}
+    for measure in MEASURES:
+        attributes[f'{measure}_cost'] = snapshot[f'{measure}_cost'][index]
+    attributes['x'] = snapshot['x'][index]
+    attributes['y'] = snapshot['y'][index]
+    return attributes
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed run cache for the Flood Adaptation Model.
+
+A run is identified by a hash of all AdaptationModel constructor arguments (including the seed),
+the run length, the checksums of the input data and the version of the model code.
+Stored reporter outputs are returned instead of re-simulating, e.g. for the baseline configuration
+that is run in every one-at-a-time sweep of the sensitivity and extreme value notebooks.
+
+Usage (from the model directory):
+    cache = RunCache()
+    model_data, agent_data = cache.run(run_length=400, seed=0, number_of_households=500, subsidy_rate=0.5, ...)
+"""
+import hashlib
+import inspect
+import json
+import numbers
+import os
+
+from model import AdaptationModel
+from functions import input_data_checksum, code_version, load_pickle_file, save_pickle_file, evict_least_recently_used
+
+# default location of the cache (relative to the model directory, like the flood maps)
+cache_path = r'../run_cache'
+# default maximum size of the cache on disk (2 GB)
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+# constructor arguments that do not change the results of a run, so they are not part of the key
+NON_RESULT_ARGUMENTS = ['population_cache', 'record_trajectories']
+
+
+def model_arguments(**kwargs):
+    """Return all AdaptationModel constructor arguments, with the defaults filled in for arguments that are not given."""
+    signature = inspect.signature(AdaptationModel.__init__)
+    bound = signature.bind(None, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    arguments.pop('self')
+    for argument in NON_RESULT_ARGUMENTS:
+        arguments.pop(argument, None)
+    return arguments
+
+
+def normalize_argument(value):
+    """Convert numbers to floats, so that e.g. subsidy_rate=1 and subsidy_rate=1.0 give the same key."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [normalize_argument(item) for item in value]
+    if isinstance(value, dict):
+        return {name: normalize_argument(item) for name, item in value.items()}
+    return value
+
+
+def run_key(run_length, **kwargs):
+    """
+    Return the cache key of a run.
+
+    Parameters
+    ----------
+    run_length: number of steps of the run
+    kwargs: AdaptationModel constructor arguments (including the seed)
+
+    Returns
+    -------
+    key: sha256 hash of the constructor arguments, run length, input data checksum and code version
+    """
+    content = {'arguments': normalize_argument(model_arguments(**kwargs)),
+               'run_length': normalize_argument(run_length),
+               'input_data': input_data_checksum(),
+               'code_version': code_version()}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunCache:
+    """
+    Cache of model runs on disk, storing the model and agent reporter dataframes of each run.
+    The cache is bounded in size; the least recently used runs are evicted first.
+    """
+    def __init__(self, path=cache_path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size # maximum size of the cache in bytes
+        self.hits = 0 # number of runs returned from the cache
+        self.misses = 0 # number of runs simulated
+        os.makedirs(self.path, exist_ok=True)
+
+    def file_path(self, key):
+        return os.path.join(self.path, f'{key}.pkl')
+
+    def get(self, key):
+        """Return the stored (model_data, agent_data) of a run, or None if the run is not cached."""
+        return load_pickle_file(self.file_path(key))
+
+    def put(self, key, result):
+        """Store the (model_data, agent_data) of a run and evict old runs if the cache is too large."""
+        save_pickle_file(self.file_path(key), result)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used runs until the cache fits within its maximum size."""
+        evict_least_recently_used(self.path, self.max_size)
+
+    def run(self, run_length, collect_agent_data=True, **kwargs):
+        """
+        Return the reporter outputs of a run, from the cache if available, otherwise by running the model.
+
+        Parameters
+        ----------
+        run_length: number of steps to run
+        collect_agent_data: whether the agent reporter dataframe is returned (and stored)
+        kwargs: AdaptationModel constructor arguments (including the seed)
+
+        Returns
+        -------
+        model_data, agent_data: the model and agent reporter dataframes (agent_data is None if not collected)
+        """
+        # runs without a seed are not reproducible, so they are never cached
+        if kwargs.get('seed') is None:
+            return self.simulate(run_length, collect_agent_data, **kwargs)
+        key = run_key(run_length, **kwargs)
+        result = self.get(key)
+        if result is not None and (result[1] is not None or not collect_agent_data):
+            self.hits += 1
+            return result[0], (result[1] if collect_agent_data else None)
+        self.misses += 1
+        result = self.simulate(run_length, collect_agent_data, **kwargs)
+        self.put(key, result)
+        return result
+
+    @staticmethod
+    def simulate(run_length, collect_agent_data=True, **kwargs):
+        """Run the model and return its model and agent reporter dataframes."""
+        model = AdaptationModel(**kwargs)
+        for tick in range(run_length):
+            model.step()
+        model_data = model.datacollector.get_model_vars_dataframe()
+        agent_data = model.datacollector.get_agent_vars_dataframe() if collect_agent_data else None
+        return model_data, agent_data
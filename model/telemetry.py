@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Telemetry for parameter sweeps of the Flood Adaptation Model.
+
+Records the throughput (runs completed per second), the ETA, the wall time and peak memory of every run
+and the slowest parameter combinations (the wall times of the replications, which differ only in the seed,
+are grouped per combination). The metrics are written continuously to local files:
+a JSON lines file with one record per run, and a Prometheus textfile (e.g. for the node exporter textfile
+collector) with the current state of the sweep. Every worker process writes its own Prometheus file
+(sweep_metrics.<pid>.prom), so the collector merges the series of all workers and a stalled worker can be
+detected by its last update timestamp. A worker that has finished its sweep reports abm_sweep_finished 1,
+so its timestamp stopping is not a false alarm. No network service is needed.
+
+Usage (from the model directory):
+    telemetry = SweepTelemetry(total_runs=len(parameter_sets) * replication_number)
+    for parameters in parameter_sets:
+        for seed in range(replication_number):
+            with telemetry.track_run(seed=seed, **parameters):
+                model = AdaptationModel(seed=seed, **parameters)
+                for tick in range(run_length):
+                    model.step()
+    telemetry.close()
+
+Per-run peak memory is only measured with trace_memory=True. It uses tracemalloc, which slows down the runs
+considerably (and with them the measured throughput and ETA), so only switch it on to find memory-hungry runs.
+"""
+import heapq
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource # only available on unix
+except ImportError:
+    resource = None
+
+# default location of the metrics files (relative to the model directory)
+metrics_path = r'../output/sweep_metrics.jsonl'
+# {worker} is replaced by the process id, one file per worker
+prometheus_path = r'../output/sweep_metrics.{worker}.prom'
+# parameters that only distinguish the replications of a parameter combination
+REPLICATION_PARAMETERS = ['seed']
+
+
+def process_peak_memory():
+    """Return the peak resident memory of the process in bytes, or None if it is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def escape_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SweepTelemetry:
+    """
+    Telemetry of a sweep of model runs, written to a JSON lines file and a Prometheus textfile after every run.
+    """
+    def __init__(self, total_runs, metrics_path=metrics_path, prometheus_path=prometheus_path,
+                 number_of_slowest=10, trace_memory=False, sweep_name='sweep'):
+        """
+        Parameters
+        ----------
+        total_runs: total number of runs in the sweep, used for the ETA
+        metrics_path: path of the JSON lines file (appended to)
+        prometheus_path: path of the Prometheus textfile (replaced after every run), {worker} is replaced by the process id
+        number_of_slowest: number of slowest parameter combinations (by mean wall time) that are reported
+        trace_memory: whether the peak python memory of every run is traced (tracemalloc, slows down the runs considerably)
+        sweep_name: name of the sweep, added as label to the Prometheus metrics
+        """
+        self.total_runs = total_runs
+        self.metrics_path = metrics_path
+        self.number_of_slowest = number_of_slowest
+        self.trace_memory = trace_memory
+        self.sweep_name = sweep_name
+        self.worker = os.getpid()
+        self.prometheus_path = prometheus_path.format(worker=self.worker)
+
+        self.start_time = time.time()
+        self.runs_completed = 0
+        self.runs_failed = 0
+        self.total_wall_time = 0 # sum of the wall times of all runs
+        self.last_run = None # record of the latest run
+        self.finished = False # set by close
+        # wall times per parameter combination (without the seed): key -> [parameters, number of runs, total, maximum]
+        self.combinations = {}
+
+        # only stop tracing at the end if the telemetry started it
+        self.started_tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+        for path in [self.metrics_path, self.prometheus_path]:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def track_run(self, **parameters):
+        """Context manager that measures the run inside it and records it with its parameters."""
+        if self.trace_memory:
+            # the traced memory already includes everything the sweep holds, only the increase is due to the run
+            tracemalloc.reset_peak()
+            memory_at_start = tracemalloc.get_traced_memory()[0]
+        run_start = time.perf_counter()
+        status = 'completed'
+        try:
+            yield
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            wall_time = time.perf_counter() - run_start
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_at_start if self.trace_memory else None
+            self.record_run(parameters, wall_time, peak_memory, status)
+
+    def runs_per_second(self):
+        """Return the number of runs completed per second since the start of the sweep."""
+        elapsed = time.time() - self.start_time
+        return self.runs_completed / elapsed if elapsed > 0 else 0
+
+    def eta(self):
+        """Return the estimated time in seconds until the sweep is finished, or None before the first run."""
+        rate = self.runs_per_second()
+        if rate == 0:
+            return None
+        return max(0, self.total_runs - self.runs_completed - self.runs_failed) / rate
+
+    def record_run(self, parameters, wall_time, peak_memory=None, status='completed'):
+        """Record a finished run and write the metrics files."""
+        if status == 'completed':
+            self.runs_completed += 1
+        else:
+            self.runs_failed += 1
+        run_index = self.runs_completed + self.runs_failed
+        self.total_wall_time += wall_time
+
+        # group the replications of a parameter combination
+        combination = {name: value for name, value in parameters.items() if name not in REPLICATION_PARAMETERS}
+        key = json.dumps(combination, sort_keys=True, default=str)
+        if key not in self.combinations:
+            self.combinations[key] = [combination, 0, 0, 0]
+        entry = self.combinations[key]
+        entry[1] += 1
+        entry[2] += wall_time
+        entry[3] = max(entry[3], wall_time)
+
+        self.last_run = {'timestamp': time.time(),
+                         'sweep': self.sweep_name,
+                         'worker': self.worker,
+                         'run': run_index,
+                         'status': status,
+                         'parameters': parameters,
+                         'wall_time_seconds': wall_time,
+                         'peak_memory_bytes': peak_memory,
+                         'process_peak_memory_bytes': process_peak_memory(),
+                         'runs_completed': self.runs_completed,
+                         'runs_failed': self.runs_failed,
+                         'runs_total': self.total_runs,
+                         'runs_per_second': self.runs_per_second(),
+                         'eta_seconds': self.eta()}
+        with open(self.metrics_path, 'a') as file:
+            file.write(json.dumps(self.last_run, default=str) + '\n')
+        self.write_prometheus()
+
+    def slowest(self):
+        """
+        Return the slowest parameter combinations, slowest mean wall time first.
+
+        Returns
+        -------
+        slowest: list of (mean wall time, maximum wall time, number of runs, parameters without the seed)
+        """
+        combinations = [(total / runs, maximum, runs, combination) for combination, runs, total, maximum in self.combinations.values()]
+        return heapq.nlargest(self.number_of_slowest, combinations, key=lambda entry: entry[0])
+
+    def write_prometheus(self):
+        """Write the current state of the sweep in the Prometheus text format, replacing the file atomically."""
+        labels = f'sweep="{escape_label(self.sweep_name)}",worker="{self.worker}"'
+        gauges = [
+            ('runs_completed', 'Number of completed runs', self.runs_completed),
+            ('runs_failed', 'Number of failed runs', self.runs_failed),
+            ('runs_total', 'Total number of runs in the sweep', self.total_runs),
+            ('runs_per_second', 'Runs completed per second', self.runs_per_second()),
+            ('eta_seconds', 'Estimated time until the sweep is finished', self.eta()),
+            ('last_run_wall_time_seconds', 'Wall time of the latest run', self.last_run['wall_time_seconds'] if self.last_run else None),
+            ('last_run_peak_memory_bytes', 'Peak python memory allocated by the latest run', self.last_run['peak_memory_bytes'] if self.last_run else None),
+            ('process_peak_memory_bytes', 'Peak resident memory of the sweep process', process_peak_memory()),
+            ('mean_run_wall_time_seconds', 'Mean wall time per run',
+             self.total_wall_time / (self.runs_completed + self.runs_failed) if self.last_run else None),
+            # a scraper can detect a stalled worker when this timestamp stops increasing before it has finished
+            ('last_update_timestamp_seconds', 'Time of the latest update of the metrics', time.time()),
+            ('finished', 'Whether the worker has finished its sweep (1) or is still running (0)', int(self.finished)),
+        ]
+        lines = []
+        for name, description, value in gauges:
+            if value is None:
+                continue
+            lines.append(f'# HELP abm_sweep_{name} {description}')
+            lines.append(f'# TYPE abm_sweep_{name} gauge')
+            lines.append(f'abm_sweep_{name}{{{labels}}} {value}')
+        slowest = self.slowest()
+        combination_gauges = [
+            ('slowest_combination_mean_wall_time_seconds', 'Mean wall time of the runs of the slowest parameter combinations', 0),
+            ('slowest_combination_max_wall_time_seconds', 'Maximum wall time of the runs of the slowest parameter combinations', 1),
+            ('slowest_combination_runs', 'Number of runs of the slowest parameter combinations', 2),
+        ]
+        for name, description, position in combination_gauges:
+            lines.append(f'# HELP abm_sweep_{name} {description}')
+            lines.append(f'# TYPE abm_sweep_{name} gauge')
+            for rank, entry in enumerate(slowest, start=1):
+                parameter_labels = ''.join(f',{parameter}="{escape_label(value)}"' for parameter, value in sorted(entry[3].items()))
+                lines.append(f'abm_sweep_{name}{{{labels},rank="{rank}"{parameter_labels}}} {entry[position]}')
+
+        temporary_path = f'{self.prometheus_path}.{self.worker}.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, self.prometheus_path)
+
+    def close(self):
+        """Stop tracing the memory (if the telemetry started it) and write the final metrics, marking the worker as finished."""
+        self.finished = True
+        self.write_prometheus()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False